@@ -4,12 +4,34 @@ import random
 import threading
 import time
 
-from collections import deque
+from array import array
 
 from StreamDeck.DeviceManager import DeviceManager
 from StreamDeck.ImageHelpers import PILHelper
 
 
+RIGHT, LEFT, DOWN, UP = 0, 1, 2, 3
+# (dx, dy) for each direction, indexed by the constants above
+_DELTAS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+
+# What a key can show. EMPTY and TAIL match the key's occupancy bit.
+EMPTY, TAIL, HEAD, FRUIT = 0, 1, 2, 3
+
+
+# Native key images, keyed by deck model and colour
+_solidPics = {}
+
+
+def _solidPic(deck, color):
+    # Decks of the same model share an image format, so a new game or a
+    # second deck of that model can reuse the encoded image
+    cacheKey = (deck.deck_type(), color)
+    if cacheKey not in _solidPics:
+        _solidPics[cacheKey] = PILHelper.to_native_format(
+            deck, PILHelper.create_image(deck, color))
+    return _solidPics[cacheKey]
+
+
 class Game:
     def __init__(self, deck, wrap, speed, speedchange):
         self.deck = deck
@@ -19,25 +41,63 @@ class Game:
         
         self.rows, self.cols = deck.key_layout()
         self.allPositions = range(0, deck.key_count())
-
-        self.headPic = PILHelper.to_native_format(
-            deck, PILHelper.create_image(deck, 'green'))
-        self.snakePic = PILHelper.to_native_format(
-            deck, PILHelper.create_image(deck, 'white'))
-        self.fruitPic = PILHelper.to_native_format(
-            deck, PILHelper.create_image(deck, 'red'))
-        self.nonePic = PILHelper.to_native_format(
-            deck, PILHelper.create_image(deck, 'black'))
-
-        self.segments = deque([8])
-        self.direction = 'right'
-        self.nextDirection = 'right'
+        # The (x, y) of every key, so getCoordinate() needn't divide
+        self.keyXs = tuple(key % self.cols for key in self.allPositions)
+        self.keyYs = tuple(key // self.cols for key in self.allPositions)
+
+        # The key reached by moving in each direction from each key, or -1
+        # where that would leave the board. Wrapping is settled here, so
+        # update() only has to look its move up.
+        self.neighbors = []
+        for (dx, dy) in _DELTAS:
+            targets = []
+            for key in self.allPositions:
+                x = self.keyXs[key] + dx
+                y = self.keyYs[key] + dy
+                if self.wrap:
+                    x %= self.cols
+                    y %= self.rows
+                elif x < 0 or y < 0 or x >= self.cols or y >= self.rows:
+                    targets.append(-1)
+                    continue
+                targets.append(self.getIndex((x, y)))
+            self.neighbors.append(tuple(targets))
+
+        self.headPic = _solidPic(deck, 'green')
+        self.snakePic = _solidPic(deck, 'white')
+        self.fruitPic = _solidPic(deck, 'red')
+        self.nonePic = _solidPic(deck, 'black')
+        # Indexed by EMPTY, TAIL, HEAD and FRUIT
+        self.pics = (self.nonePic, self.snakePic, self.headPic, self.fruitPic)
+
+        # The snake is a ring buffer of key indices running from the head
+        # at headSlot back to the tail. It can never be longer than the
+        # board, so the buffer never needs to grow.
         self.length = 2
+        self.segments = array('i', [0] * deck.key_count())
+        self.headSlot = 0
+        self.segmentCount = 1
+        self.segments[self.headSlot] = 8
+        # Bit i is set iff key i is occupied by the snake
+        self.occupied = 1 << 8
+        (self.headX, self.headY) = self.getCoordinate(8)
+        self.direction = RIGHT
+        self.nextDirection = RIGHT
+        # Key callbacks run on the deck's reader thread and leave their
+        # result in pendingDirection for update() to pick up. The lock
+        # covers that and everything setDirection() reads.
+        self.pendingDirection = None
+        self.inputLock = threading.Lock()
         self.fruitPos = self.placeFruit()
 
+        # The last picture pushed to each key, and the keys that may need
+        # repainting on the next draw. Everything is dirty on a new game.
+        self.prevFrame = [None] * deck.key_count()
+        self.dirtyKeys = list(self.allPositions)
+
 
     def getCoordinate(self, key):
-        return (key % self.cols, key // self.cols)
+        return (self.keyXs[key], self.keyYs[key])
 
 
     def getIndex(self, coord):
@@ -45,114 +105,125 @@ class Game:
 
 
     def draw(self):
-        with self.deck:
-            for key in self.allPositions:
-                if key == self.fruitPos:
-                    # This space is a fruit
-                    pic = self.fruitPic
-                elif key == self.segments[0]:
-                    # This space is the snake's head
-                    pic = self.headPic
-                elif key in self.segments:
-                    # This space is part of the snake's tail
-                    pic = self.snakePic
-                else:
-                    # This space is empty
-                    pic = self.nonePic
-                self.deck.set_key_image(key, pic)
+        pics = self.pics
+        prevFrame = self.prevFrame
+        setKeyImage = self.deck.set_key_image
+        occupied = self.occupied
+        head = self.segments[self.headSlot]
+        fruit = self.fruitPos
+
+        # Work out what needs writing before taking the deck lock
+        changes = []
+        for key in self.dirtyKeys:
+            if key == fruit:
+                cell = FRUIT
+            elif key == head:
+                cell = HEAD
+            else:
+                # Part of the tail or empty
+                cell = (occupied >> key) & 1
+            pic = pics[cell]
+            if prevFrame[key] is not pic:
+                changes.append((key, pic))
+                prevFrame[key] = pic
+        self.dirtyKeys = []
+
+        if changes:
+            with self.deck:
+                for (key, pic) in changes:
+                    setKeyImage(key, pic)
 
 
     def update(self):
-        alive = True
-        nextPos = self.getNext()
-        nextIndex = self.getIndex(nextPos)
-
-        # This should always remove (at least) the last tail block,
-        # so we can move there without colliding.
-        while len(self.segments) >= self.length:
-            pos = self.segments.pop()
-
+        with self.inputLock:
+            if self.pendingDirection is not None:
+                self.nextDirection = self.pendingDirection
+                self.pendingDirection = None
+            direction = self.nextDirection
+
+        # Moving will drop the last tail block unless we're still
+        # growing, so we can move there without colliding.
+        growing = self.segmentCount < self.length
+        if not growing:
+            tailSlot = ((self.headSlot + self.segmentCount - 1)
+                        % len(self.segments))
+            pos = self.segments[tailSlot]
+            self.occupied &= ~(1 << pos)
+            self.dirtyKeys.append(pos)
+
+        nextIndex = self.neighbors[direction][self.segments[self.headSlot]]
+        # Check for leaving the board
+        if nextIndex < 0:
+            return False
         # Check for self-collision
-        if nextIndex in self.segments:
-            alive = False
+        if (self.occupied >> nextIndex) & 1:
+            return False
 
-        # Check for leaving the board
-        (nextX, nextY) = nextPos
-        if nextX < 0 or nextY < 0:
-            alive = False
-        if nextX >= self.cols or nextY >= self.rows:
-            alive = False
-        
         # Update snake position
-        self.segments.appendleft(nextIndex)
-        self.direction = self.nextDirection
-
-        if not alive:
-            return False
+        self.dirtyKeys.append(self.segments[self.headSlot])
+        self.dirtyKeys.append(nextIndex)
+        # The slot before the head is always free or the dropped tail's
+        self.headSlot = (self.headSlot - 1) % len(self.segments)
+        self.segments[self.headSlot] = nextIndex
+        if growing:
+            self.segmentCount += 1
+        self.occupied |= 1 << nextIndex
+        with self.inputLock:
+            (self.headX, self.headY) = self.getCoordinate(nextIndex)
+            self.direction = direction
             
         # Check for growth
         if nextIndex == self.fruitPos:
             self.length += 1
             self.fruitPos = self.placeFruit()
+            if self.fruitPos is not None:
+                self.dirtyKeys.append(self.fruitPos)
             self.speed -= self.speedChange
 
         return True
 
 
     def placeFruit(self):
-        options = set(self.allPositions)
-        for pos in self.segments:
-            options.remove(pos)
-        if len(options):
-            return random.choice(list(options))
-        return None
+        keyCount = len(self.allPositions)
+
+        # While the board is mostly empty, random guessing hits a free
+        # space almost immediately
+        if self.segmentCount * 4 < keyCount:
+            while True:
+                pos = random.randrange(keyCount)
+                if not (self.occupied >> pos) & 1:
+                    return pos
+
+        free = ((1 << keyCount) - 1) & ~self.occupied
+        count = free.bit_count()
+        if not count:
+            return None
+
+        # Walk the free bits until we reach the randomly chosen one
+        for _ in range(random.randrange(count)):
+            free &= free - 1
+        return (free & -free).bit_length() - 1
 
 
     def setDirection(self, key):
         (keyX, keyY) = self.getCoordinate(key)
-        (headX, headY) = self.getCoordinate(self.segments[0])
-
-        if self.direction == 'right' or self.direction == 'left':
-            if keyY < headY:
-                self.nextDirection = 'up'
-            elif keyY > headY:
-                self.nextDirection = 'down'
-        elif self.direction == 'up' or self.direction == 'down':
-            if keyX < headX:
-                self.nextDirection = 'left'
-            elif keyX > headX:
-                self.nextDirection = 'right'
-
-
-    def getNext(self):
-        (headX, headY) = self.getCoordinate(self.segments[0])
-        nextPos = (headX, headY)
-        if self.nextDirection == 'right':
-            nextPos = (headX + 1, headY)
-        elif self.nextDirection == 'left':
-            nextPos = (headX - 1, headY)
-        elif self.nextDirection == 'down':
-            nextPos = (headX, headY + 1)
-        elif self.nextDirection == 'up':
-            nextPos = (headX, headY - 1)
-
-        if self.wrap:
-            (nextX, nextY) = nextPos
-            if nextX < 0:
-                # right-side overwrap
-                nextX = self.cols - 1
-            elif nextX >= self.cols:
-                # left-side overwrap
-                nextX = 0
-            if nextY < 0:
-                # overwrap up
-                nextY = self.rows - 1
-            elif nextY >= self.rows:
-                # overwrap down
-                nextY = 0
-            nextPos = (nextX, nextY)
-
-        return nextPos
+
+        with self.inputLock:
+            headX = self.headX
+            headY = self.headY
+            direction = self.direction
+
+            # Only turns are possible, never reversing
+            if direction == RIGHT or direction == LEFT:
+                if keyY < headY:
+                    self.pendingDirection = UP
+                elif keyY > headY:
+                    self.pendingDirection = DOWN
+            else:
+                if keyX < headX:
+                    self.pendingDirection = LEFT
+                elif keyX > headX:
+                    self.pendingDirection = RIGHT
 
 
 if __name__ == "__main__":
@@ -193,21 +264,32 @@ if __name__ == "__main__":
 
     deck.set_key_callback(key_change_callback)
 
-    running = True
-    while running:
-        running = GAMESTATE.update()
-        if not running:
-            deck.close()
+    # Tick on a fixed deadline so drawing time doesn't stretch the period
+    nextTick = time.monotonic()
+    while True:
+        period = GAMESTATE.speed
+        if not GAMESTATE.update():
+            break
+        GAMESTATE.draw()
+        nextTick += period
+        sleepFor = nextTick - time.monotonic()
+        if sleepFor > 0:
+            time.sleep(sleepFor)
         else:
-            GAMESTATE.draw()
-            time.sleep(GAMESTATE.speed)
-    
-    # Wait until all application threads have terminated
-    # (for this example, this is when all deck handles are closed).
+            # We've fallen behind, don't try to catch up
+            nextTick = time.monotonic()
+
+    deck.reset()
+    deck.close()
+
+    # Give any remaining application threads a moment to finish, but
+    # don't hang on one that won't. The deck's reader thread is a daemon
+    # and won't keep us alive.
     for t in threading.enumerate():
-        try:
-            t.join()
-        except RuntimeError:
-            pass
-        
+        if t is threading.main_thread() or t.daemon:
+            continue
+        t.join(timeout=1.0)
+        if t.is_alive():
+            print("Thread '{}' did not exit".format(t.name))
+
     print("Done")